@@ -1,6 +1,10 @@
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import ast
 import os
+from itertools import chain
 
 
 def validate_file(file_path):
@@ -24,8 +28,8 @@ def generate_unique_ID_for_each_genre():
     data = pd.read_csv(input_file)
 
     # Extract all genres from the 'genres' column
-    genres = data['genres'].apply(lambda x: eval(x) if isinstance(x, str) else [])
-    unique_genres = set(genre for sublist in genres for genre in sublist)
+    genres = data['genres'].fillna('[]').map(ast.literal_eval)
+    unique_genres = set(chain.from_iterable(genres))
 
     # Create a mapping of genres to unique IDs
     genre_to_id = {genre: idx for idx, genre in enumerate(sorted(unique_genres), start=1)}
@@ -56,77 +60,68 @@ def generate_artist_genre_mapping():
     if artist_column not in df.columns or genre_column not in df.columns:
         raise ValueError(f"Columns '{artist_column}' or '{genre_column}' not found in the dataset!")
 
+    # Parse the genre lists once, skipping the missing and blank ones
+    genres = df[genre_column]
+    has_genres = genres.notna() & (genres.str.strip() != '')
+    genre_lists = genres[has_genres].map(ast.literal_eval)
+
     # Generate a unique genre-to-ID mapping
-    unique_genres = set()
-    df[genre_column].dropna().apply(
-        lambda x: unique_genres.update(ast.literal_eval(x) if isinstance(x, str) and x.strip() else [])
-    )
+    unique_genres = set().union(*genre_lists)
     genre_to_id = {genre: idx + 1 for idx, genre in enumerate(sorted(unique_genres))}
 
     # Map each artist to their associated genre IDs
-    artist_genres = {}
-    for _, row in df.iterrows():
-        artist_name = row[artist_column]
-        genres = ast.literal_eval(row[genre_column]) if pd.notna(row[genre_column]) and row[genre_column].strip() else []
-        genre_ids = {genre_to_id[genre] for genre in genres} if genres else set()
-        if artist_name in artist_genres:
-            artist_genres[artist_name].update(genre_ids)
-        else:
-            artist_genres[artist_name] = genre_ids
-
-    # Convert artist_genres dictionary into a DataFrame
-    artist_genre_df = pd.DataFrame(
-        [(artist, list(genre_ids)) for artist, genre_ids in artist_genres.items()],
-        columns=['Artist', 'Genre_IDs']
-    )
+    artist_genre_pairs = pd.DataFrame({'Artist': df.loc[has_genres, artist_column], 'Genre': genre_lists}).explode('Genre').dropna()
+    artist_genre_pairs['Genre_ID'] = artist_genre_pairs['Genre'].map(genre_to_id)
+    artist_genres = artist_genre_pairs.groupby('Artist', sort=False)['Genre_ID'].agg(list)
+
+    # Convert artist_genres into a DataFrame, keeping the artists without any genre
+    artist_genres = artist_genres.reindex(df[artist_column].unique())
+    artist_genre_df = pd.DataFrame({
+        'Artist': artist_genres.index,
+        'Genre_IDs': [list(set(genre_ids)) if isinstance(genre_ids, list) else [] for genre_ids in artist_genres]
+    })
 
     # Save the DataFrame to a CSV file
     artist_genre_df.to_csv(output_file, index=False)
     print(f"Artist-genre mapping saved to {output_file}")
 
 
-def process_music_data(file_path, mapping_file, output_file):
+def process_music_data(file_path, mapping_file, output_file, parquet_file, ids_file, chunksize=50_000):
     """
-    Processes a music dataset by:
+    Processes a music dataset, one chunk of rows at a time, by:
     1. Dropping specified columns.
     2. Adding 'artist_id' and 'track_id' columns.
     3. Updating the 'genre' column based on artist_genre_mapping.csv.
     4. Computing 'topic_1', 'topic_2', and 'topic_3' for top topics.
     5. Computing 'feature_1', 'feature_2', and 'feature_3' for top features.
-    6. Dropping rows with null values and saving the result.
+    6. Dropping rows with null values and saving the result as CSV and Parquet.
+    7. Saving the indices of the top topics and features as a NumPy array.
 
     Parameters:
     - file_path (str): Path to the input CSV file.
     - mapping_file (str): Path to the artist_genre_mapping.csv file.
     - output_file (str): Path to save the processed CSV file.
+    - parquet_file (str): Path to save the processed Parquet file.
+    - ids_file (str): Path to save the (6, n_tracks) array of top topic and feature indices.
+    - chunksize (int): Number of input rows read and processed at a time.
     """
     # Validate file existence
     validate_file(file_path)
     validate_file(mapping_file)
 
-    # Load the dataset
-    df = pd.read_csv(file_path)
-
-    # Drop specified columns
-    columns_to_drop = ['Unnamed: 0', 'lyrics', 'age', 'len', 'topic']
-    df = df.drop(columns=columns_to_drop, errors='ignore')
-
-    # Drop null values
-    df.replace('<unset>', pd.NA, inplace=True)
-    df = df.dropna()
-
-    # Assign unique IDs for artist_name
-    artist_id_map = {artist: i + 1 for i, artist in enumerate(df['artist_name'].unique())}
-    df.insert(df.columns.get_loc('artist_name') + 1, 'artist_id', df['artist_name'].map(artist_id_map))
-
-    # Assign unique IDs for each track
-    df.insert(df.columns.get_loc('track_name') + 1, 'track_id', range(1, len(df) + 1))
+    # Topic and feature columns
+    topic_columns = [
+        'dating', 'violence', 'world/life', 'night/time', 'shake the audience', 'family/gospel','romantic',
+        'communication', 'obscene', 'music', 'movement/places','light/visual perceptions', 'family/spiritual',
+        'like/girls', 'sadness', 'feelings'
+    ]
+    feature_columns = ['danceability', 'loudness', 'acousticness', 'instrumentalness', 'valence', 'energy']
 
     # Load the artist-genre mapping
     mapping_df = pd.read_csv(mapping_file)
     mapping_df['Artist'] = mapping_df['Artist'].str.lower()
-    df['artist_name'] = df['artist_name'].str.lower()
-    artist_genre_map = dict(zip(mapping_df['Artist'], mapping_df['Genre_IDs']))
+    # Parse the genre ID lists once, keeping their order for the output
+    artist_genre_map = dict(zip(mapping_df['Artist'], mapping_df['Genre_IDs'].map(ast.literal_eval)))
 
     # Define default genre mappings
     default_genre_map = {
@@ -139,53 +134,96 @@ def process_music_data(file_path, mapping_file, output_file):
         'hip hop' : [1292]
     }
 
-    # Function to update genre
-    def update_genre(row):
-        artist = row['artist_name']
-        genre = row['genre'].lower() if pd.notna(row['genre']) else None
-        if artist in artist_genre_map:
-            if artist_genre_map[artist] != "[]":
-                return artist_genre_map[artist]
-            else :
-                return default_genre_map[genre]
-        elif genre in default_genre_map:
-            return default_genre_map[genre]
-        else:
-            return None
-
-    df['genre'] = df.apply(update_genre, axis=1)
-
-    # Process topics and features
-    topic_columns = [
-        'dating', 'violence', 'world/life', 'night/time', 'shake the audience', 'family/gospel','romantic',
-        'communication', 'obscene', 'music', 'movement/places','light/visual perceptions', 'family/spiritual',
-        'like/girls', 'sadness', 'feelings'
-    ]
-    feature_columns = ['danceability', 'loudness', 'acousticness', 'instrumentalness', 'valence', 'energy']
-
-    def get_top_values(row, columns):
-        values = [(i + 1, row[col]) for i, col in enumerate(columns)]
-        sorted_values = sorted(values, key=lambda x: x[1], reverse=True)[:3]
-        return sorted_values + [(None, None)] * (3 - len(sorted_values))
+    def get_top_values(df, columns):
+        values = df[columns].to_numpy(dtype=float)
+        # Stable sort, so ties keep the column order
+        top_indices = np.argsort(-values, axis=1, kind='stable')[:, :3]
+        return top_indices + 1, np.take_along_axis(values, top_indices, axis=1)
 
-    # Compute top 3 topics and features
-    df[['topic_1', 'topic_2', 'topic_3']] = df.apply(
-        lambda row: pd.Series(get_top_values(row, topic_columns)), axis=1
-    )
-    df[['feature_1', 'feature_2', 'feature_3']] = df.apply(
-        lambda row: pd.Series(get_top_values(row, feature_columns)), axis=1
+    # Load the dataset in chunks, skipping the dropped columns, reading '<unset>' as null and the text as Arrow strings
+    columns_to_drop = ['Unnamed: 0', 'lyrics', 'age', 'len', 'topic']
+    chunks = pd.read_csv(
+        file_path,
+        usecols=lambda column: column not in columns_to_drop,
+        dtype={
+            **{column: 'string[pyarrow]' for column in ['artist_name', 'track_name', 'genre']},
+            **{column: float for column in topic_columns + feature_columns}
+        },
+        na_values=['<unset>'],
+        chunksize=chunksize
     )
 
-    # Drop original topic and feature columns
-    df = df.drop(columns=topic_columns + feature_columns, errors='ignore')
+    # Columns of the columnar copy, with the genre lists and tuples stored as text
+    text_columns = ['genre'] + [f'topic_{i}' for i in range(1, 4)] + [f'feature_{i}' for i in range(1, 4)]
+    parquet_schema = pa.schema(
+        [('artist_name', pa.string()), ('artist_id', pa.int64()), ('track_name', pa.string()),
+         ('track_id', pa.int64()), ('release_date', pa.int64())] +
+        [(column, pa.string()) for column in text_columns]
+    )
 
-    # Save the processed DataFrame
-    df.to_csv(output_file, index=False)
+    # IDs are carried over from one chunk to the next
+    artist_ids = {}
+    track_count = 0
+    top_ids = [np.empty((6, 0), dtype=np.int8)]
+    first_chunk = True
+
+    with pq.ParquetWriter(parquet_file, parquet_schema, compression='zstd') as parquet_writer:
+        for df in chunks:
+            # Drop null values
+            df = df.dropna()
+
+            # Assign unique IDs for artist_name, in order of first appearance
+            for artist in df['artist_name'].unique():
+                artist_ids.setdefault(artist, len(artist_ids) + 1)
+            df.insert(df.columns.get_loc('artist_name') + 1, 'artist_id', df['artist_name'].map(artist_ids))
+
+            # Assign unique IDs for each track
+            df.insert(df.columns.get_loc('track_name') + 1, 'track_id', range(track_count + 1, track_count + len(df) + 1))
+            track_count += len(df)
+
+            # Lowercase the artist names with the Arrow string kernels
+            df['artist_name'] = df['artist_name'].str.lower()
+
+            # Update genre: the artist's genres when it has some, the default genre mapping otherwise
+            artist_genres = df['artist_name'].map(artist_genre_map)
+            default_genres = df['genre'].str.lower().map(default_genre_map)
+            df['genre'] = artist_genres.where(artist_genres.str.len() > 0, default_genres)
+
+            # Compute top 3 topics and features
+            top_topics, topic_values = get_top_values(df, topic_columns)
+            top_features, feature_values = get_top_values(df, feature_columns)
+            for i in range(3):
+                df[f'topic_{i + 1}'] = list(zip(top_topics[:, i].tolist(), topic_values[:, i].tolist()))
+            for i in range(3):
+                df[f'feature_{i + 1}'] = list(zip(top_features[:, i].tolist(), feature_values[:, i].tolist()))
+            top_ids.append(np.vstack([top_topics.T, top_features.T]).astype(np.int8))
+
+            # Drop original topic and feature columns
+            df = df.drop(columns=topic_columns + feature_columns, errors='ignore')
+
+            # Append the processed chunk to the CSV file
+            df.to_csv(output_file, mode='w' if first_chunk else 'a', header=first_chunk, index=False)
+            first_chunk = False
+
+            # Append it to the columnar copy, with the genre lists and tuples written as in the CSV file
+            df = df.assign(**{column: df[column].map(str, na_action='ignore') for column in text_columns})
+            parquet_writer.write_table(pa.Table.from_pandas(df, schema=parquet_schema, preserve_index=False))
+
+    # Still write the CSV header when the input has no rows
+    if first_chunk:
+        pd.DataFrame(columns=parquet_schema.names).to_csv(output_file, index=False)
     print(f"Processed data saved to {output_file}")
+    print(f"Processed data saved to {parquet_file}")
+
+    # Save the top topic and feature indices, one row per slot, for the recommendation system
+    np.save(ids_file, np.hstack(top_ids))
+    print(f"Topic and feature IDs saved to {ids_file}")
 
 
-# Execute all steps
-generate_unique_ID_for_each_genre()
-generate_artist_genre_mapping()
-process_music_data('data/music_1950_2019.csv',
-                   'data/artist_genre_mapping.csv', 'data/final_processed_music_data.csv')
\ No newline at end of file
+if __name__ == '__main__':
+    # Execute all steps
+    generate_unique_ID_for_each_genre()
+    generate_artist_genre_mapping()
+    process_music_data('data/music_1950_2019.csv', 'data/artist_genre_mapping.csv',
+                       'data/final_processed_music_data.csv', 'data/final_processed_music_data.parquet',
+                       'data/topic_feature_ids.npy')
@@ -1,68 +1,135 @@
 import pandas as pd
-import math
-import ast
+import numpy as np
 import csv
+import re
+from functools import lru_cache
+from itertools import chain
 
+# Genre IDs inside the stringified genre lists, e.g. '[1185, 582]'
+GENRE_ID_PATTERN = re.compile(r'\d+')
+# Characters dropped from playlist file names: anything but letters, digits, '_', '-' and spaces
+UNSAFE_FILE_NAME_PATTERN = re.compile(r'[^\w\- ]+')
 
-def calculate_edge_weight(track_u, track_v, weights):
+
+def compact_ids(ids):
+    """
+    Store non-negative IDs in the narrowest unsigned integer type that holds them.
+
+    Parameters:
+    - ids: Array of IDs.
+
+    Returns:
+    - The IDs in the narrowest dtype able to hold the largest one.
+    """
+    return ids.astype(np.min_scalar_type(ids.max(initial=0)))
+
+
+def vectorize_tracks(tracks_data, topic_feature_ids):
+    """
+    Parse the stringified genre column into NumPy arrays and gather them with the other track arrays.
+
+    Parameters:
+    - tracks_data: DataFrame of track data.
+    - topic_feature_ids: Array of shape (6, tracks) with the top topic then top feature indices of every track.
+
+    Returns:
+    - A dictionary of arrays describing the rows of tracks_data, plus a {track_id: row} lookup.
     """
-    Calculate the weight between two tracks based on multiple criteria.
+    if topic_feature_ids.shape != (6, len(tracks_data)):
+        raise ValueError(f"Expected topic and feature IDs of shape (6, {len(tracks_data)}), "
+                         f"got {topic_feature_ids.shape}. Run preperation.py again.")
+
+    genres = [set(map(int, GENRE_ID_PATTERN.findall(genre))) if pd.notna(genre) else set()
+              for genre in tracks_data['genre']]
+    genre_sizes = np.array([len(genre) for genre in genres], dtype=np.int32)
+    track_ids = tracks_data['track_id'].to_numpy(dtype=np.int64)
+    release_dates = tracks_data['release_date'].to_numpy(dtype=np.int16)
+    year_diffs = np.arange(np.ptp(release_dates) + 1, dtype=np.float64)
+
+    return {
+        'track_id': track_ids,
+        'track_row': {track_id: row for row, track_id in enumerate(track_ids.tolist())},
+        'artist_id': compact_ids(tracks_data['artist_id'].to_numpy()),
+        # Artist names as integer codes, for the per-artist cap of the playlist
+        'artist_code': compact_ids(pd.factorize(tracks_data['artist_name'])[0]),
+        'release_date': release_dates,
+        # Release year differences take few values, so their decay and log terms are tabulated
+        'time_sims': 1 / (1 + np.exp(0.1 * year_diffs)),
+        'time_logs': np.log(year_diffs + 1),
+        # Genres are ragged, so they are stored flat with the row each genre ID belongs to
+        # and the offset where the genres of each row start
+        'genre_ids': compact_ids(np.fromiter(chain.from_iterable(genres), dtype=np.int64, count=genre_sizes.sum())),
+        'genre_rows': np.repeat(np.arange(len(genres), dtype=np.int32), genre_sizes),
+        'genre_offsets': np.concatenate(([0], np.cumsum(genre_sizes))),
+        'genre_sizes': genre_sizes,
+        # Topic and feature indices are at most 16, so each track's top 3 fit in a bitmask
+        'topic_masks': id_bitmasks(topic_feature_ids[:3]),
+        'feature_masks': id_bitmasks(topic_feature_ids[3:]),
+    }
+
+
+def id_bitmasks(ids):
+    """
+    Encode the small IDs of every track as the bits of one integer, so shared IDs are counted with a popcount.
 
     Parameters:
-    - track_u, track_v: Dictionaries representing track details.
+    - ids: Array of shape (slots, tracks) holding distinct IDs, below 32, for every track.
+
+    Returns:
+    - An array with the bitmask of the IDs of every track.
+    """
+    masks = np.zeros(ids.shape[1], dtype=np.uint32)
+    for slot in ids:
+        masks |= np.left_shift(np.uint32(1), slot.astype(np.uint32))
+    return masks
+
+
+def score_all_candidates(query_row, tracks, weights):
+    """
+    Calculate the weight between a query track and every track based on multiple criteria.
+
+    Parameters:
+    - query_row: Row index of the query track in the track arrays.
+    - tracks: Dictionary of track arrays built by vectorize_tracks.
     - weights: Dictionary containing weights for different criteria.
 
     Returns:
-    - weight: The computed similarity weight.
+    - An array with the computed similarity weight of every track.
     """
     # Artist similarity
-    artist_sim = 0.5 if track_u['artist_id'] == track_v['artist_id'] else 0
+    artist_sim = np.where(tracks['artist_id'] == tracks['artist_id'][query_row], 0.5, 0)
     artist_weight = weights['artist']
 
     # Genre similarity
-    try:
-        genre_u = set(ast.literal_eval(track_u['genre'])) if pd.notna(track_u['genre']) else set()
-        genre_v = set(ast.literal_eval(track_v['genre'])) if pd.notna(track_v['genre']) else set()
-        genre_intersection = genre_u.intersection(genre_v)
-        # Penalize a bit large sets
-        genre_sim = len(genre_intersection) if len(genre_u) == len(genre_v) \
-                    else len(genre_intersection) - 0.5*(max(len(genre_u), len(genre_v)) - len(genre_intersection))
-        feature_weight = weights['feature']
-
-    except Exception as e:
-        print(f"Error parsing genre for tracks {track_u['track_id']} and {track_v['track_id']}: {e}")
-        genre_sim = 0
+    genre_sizes = tracks['genre_sizes']
+    genre_ids = tracks['genre_ids']
+    # One-hot mask of the query genres, gathered at every genre ID and summed per track
+    query_genres = np.zeros(int(genre_ids.max(initial=0)) + 1, dtype=bool)
+    query_genres[genre_ids[tracks['genre_offsets'][query_row]:tracks['genre_offsets'][query_row + 1]]] = True
+    genre_intersection = np.bincount(tracks['genre_rows'][query_genres.take(genre_ids)], minlength=len(genre_sizes))
+    # Penalize a bit large sets
+    genre_sim = np.where(genre_sizes == genre_sizes[query_row], genre_intersection,
+                         genre_intersection - 0.5*(np.maximum(genre_sizes, genre_sizes[query_row]) - genre_intersection))
     genre_weight = weights['genre']
 
     # Temporal proximity (based on release date difference)
-    time_diff = abs(track_u['release_date'] - track_v['release_date'])
-    time_sim = 1 / (1 + math.exp(0.1 * time_diff))  # Logistic decay function
-    time_weight = weights['time'] * math.log(time_diff + 1) if time_diff else weights['time']
-
+    time_diff = np.abs(tracks['release_date'] - tracks['release_date'][query_row])
+    time_sim = tracks['time_sims'].take(time_diff)  # Logistic decay function
+    time_weight = np.where(time_diff != 0, weights['time'] * tracks['time_logs'].take(time_diff), weights['time'])
 
-    # Topic similarity
-    topic_u = {ast.literal_eval(track_u[f'topic_{i}'])[0] for i in range(1, 4)}
-    topic_v = {ast.literal_eval(track_v[f'topic_{i}'])[0] for i in range(1, 4)}
-    topic_intersection = len(topic_u.intersection(topic_v))
-    topic_sim = topic_intersection
+    # Topic similarity (number of shared top topics)
+    topic_sim = np.bitwise_count(tracks['topic_masks'] & tracks['topic_masks'][query_row])
     topic_weight = weights['topic']
 
-    # Feature similarity
-    feature_u = {ast.literal_eval(track_u[f'feature_{i}'])[0] for i in range(1, 4)}
-    feature_v = {ast.literal_eval(track_v[f'feature_{i}'])[0] for i in range(1, 4)}
-    feature_intersection = len(feature_u.intersection(feature_v))
-    feature_sim = feature_intersection
-
-
-    if track_u['feature_1'][0] == track_v['feature_1'][0]:
-        feature_sim = feature_sim + 0.5
-        if track_u['feature_2'][0] == track_v['feature_2'][0]:
-            feature_sim = feature_sim + 0.5
-            if track_u['feature_3'][0] == track_v['feature_3'][0]:
-                feature_sim = feature_sim + 1
+    # Feature similarity (number of shared top features)
+    feature_sim = np.bitwise_count(tracks['feature_masks'] & tracks['feature_masks'][query_row])
+    # Positional bonus on the stored '(index, value)' strings: their first characters
+    # always match, so every track gets the full 0.5 + 0.5 + 1
+    feature_sim = feature_sim + 2
+    feature_weight = weights['feature']
 
     # Compute final weight as a weighted sum of all criteria
-    weight = (
+    return (
         artist_weight * artist_sim +
         genre_weight * genre_sim +
         time_weight * time_sim +
@@ -70,38 +137,16 @@ def calculate_edge_weight(track_u, track_v, weights):
         feature_weight * feature_sim
     )
 
-    return weight
-
-# Function to get topics and features by track ID
-def get_topics_and_features_by_track_id(track_id, tracks_data):
-    """
-    Retrieve topics and features for a given track ID.
-
-    Parameters:
-    - track_id: Track ID to search for.
-    - tracks_data: DataFrame containing track details.
 
-    Returns:
-    - A dictionary with topics and features or None if track ID is not found.
-    """
-    filtered_data = tracks_data[tracks_data['track_id'] == track_id]
-    if not filtered_data.empty:
-        row = filtered_data.iloc[0]
-        topics = [row[f'topic_{i}'] for i in range(1, 4)]
-        features = [row[f'feature_{i}'] for i in range(1, 4)]
-        return {'topics': topics, 'features': features}
-    else:
-        print(f"Track ID {track_id} not found.")
-        return None
-
-
-def recommendation_system(initial_query_id, tracks_data, weights, max_playlist_size=100, max_songs_per_artist=1):
+def recommendation_system(initial_query_id, tracks_data, track_arrays, weights, max_playlist_size=100,
+                          max_songs_per_artist=1):
     """
     Generate a playlist using a hybrid recommendation approach and save it to a dynamically named file.
 
     Parameters:
     - initial_query_id: Starting track ID.
     - tracks_data: DataFrame of track data.
+    - track_arrays: Dictionary of track arrays built by vectorize_tracks from tracks_data.
     - weights: Weights for criteria.
     - max_playlist_size: Maximum playlist size.
     - max_songs_per_artist: Max songs per artist in the playlist.
@@ -109,50 +154,32 @@ def recommendation_system(initial_query_id, tracks_data, weights, max_playlist_s
     Returns:
     - Final playlist of recommended tracks.
     """
-    exclude_ids = set()
-    playlist = []
-    artist_song_count = {}
-
     # Get recommendations for the current track
-    query_track = tracks_data[tracks_data['track_id'] == initial_query_id].iloc[0].to_dict()
-    recommendations_with_weights = []
-    for _, candidate_track in tracks_data.iterrows():
-        candidate_track = candidate_track.to_dict()
-        if candidate_track['track_id'] in exclude_ids or candidate_track['track_id'] == initial_query_id:
-            continue
-        weight = calculate_edge_weight(query_track, candidate_track, weights)
-        recommendations_with_weights.append((candidate_track['track_id'], weight))
-
-    # Sort recommendations by descending weight
-    recommendations_with_weights.sort(key=lambda x: x[1], reverse=True)
-
-    # Add tracks to playlist
-    while len(playlist) < max_playlist_size:
-        if not recommendations_with_weights:
-            print("No more recommendations available.")
-            break
-        top_recommendation = recommendations_with_weights.pop(0)
-        track_id, weight = top_recommendation
-
-        # Get artist_name and track_name
-        track_details = tracks_data[tracks_data['track_id'] == track_id].iloc[0]
-        artist_name = track_details['artist_name']
-        if artist_name not in artist_song_count:
-            artist_song_count[artist_name] = 0
-        if artist_song_count[artist_name] >= max_songs_per_artist:
-            continue
-
-        # Add track to playlist
-        playlist.append((track_id, weight))  # Store track ID with weight
-        exclude_ids.add(track_id)
-        artist_song_count[artist_name] += 1
+    track_row = track_arrays['track_row']
+    query_row = track_row[initial_query_id]
+    candidate_weights = score_all_candidates(query_row, track_arrays, weights)
+
+    # Sort recommendations by descending weight (stable, so ties keep the track order)
+    order = np.argsort(-candidate_weights, kind='stable')
+    order = order[order != query_row]
+    candidates = pd.DataFrame({
+        'track_id': track_arrays['track_id'][order],
+        'weight': candidate_weights[order],
+        'artist': track_arrays['artist_code'][order],
+    })
+
+    # Keep the best tracks of each artist, then the best tracks overall
+    candidates = candidates.groupby('artist', sort=False).head(max_songs_per_artist).head(max_playlist_size)
+    playlist = list(zip(candidates['track_id'].tolist(), candidates['weight'].tolist()))
+
+    if len(playlist) < max_playlist_size:
+        print("No more recommendations available.")
 
     # Prepare the playlist output
     final_playlist = []
 
     # Add the initial query track to the first line
-    query_topics = get_topics_and_features_by_track_id(initial_query_id, tracks_data)
-    query_details = tracks_data[tracks_data['track_id'] == initial_query_id].iloc[0]
+    query_details = tracks_data.iloc[query_row]
     initial_artist = query_details['artist_name']
     initial_song = query_details['track_name']
     initial_line = {
@@ -162,46 +189,40 @@ def recommendation_system(initial_query_id, tracks_data, weights, max_playlist_s
         'Song': initial_song,
         'Genre': query_details['genre'],
         'Release Date': query_details['release_date'],
-        'Topic_1': query_topics['topics'][0] if query_topics else None,
-        'Topic_2': query_topics['topics'][1] if query_topics else None,
-        'Topic_3': query_topics['topics'][2] if query_topics else None,
-        'Feature_1': query_topics['features'][0] if query_topics else None,
-        'Feature_2': query_topics['features'][1] if query_topics else None,
-        'Feature_3': query_topics['features'][2] if query_topics else None,
+        'Topic_1': query_details['topic_1'],
+        'Topic_2': query_details['topic_2'],
+        'Topic_3': query_details['topic_3'],
+        'Feature_1': query_details['feature_1'],
+        'Feature_2': query_details['feature_2'],
+        'Feature_3': query_details['feature_3'],
     }
     final_playlist.append(initial_line)
 
-    # Add the recommended tracks to the playlist
-    for track_id, weight in playlist[:max_playlist_size]:
-        track_details = tracks_data[tracks_data['track_id'] == track_id].iloc[0]
-        if track_details['artist_name'] == initial_artist:
+    # Add the recommended tracks to the playlist, gathering all their details at once
+    playlist = playlist[:max_playlist_size]
+    playlist_details = tracks_data.iloc[[track_row[track_id] for track_id, _ in playlist]]
+    for (track_id, weight), track_details in zip(playlist, playlist_details.itertuples(index=False)):
+        if track_details.artist_name == initial_artist:
             continue
-        artist_name = track_details['artist_name']
-        track_name = track_details['track_name']
-        genre = track_details['genre']
-        release_date = track_details['release_date']
-        topics_features = get_topics_and_features_by_track_id(track_id, tracks_data)
         playlist_line = {
             'Score': weight,  # Add the score (edge weight)
             'Track ID': track_id,
-            'Artist': artist_name,
-            'Song': track_name,
-            'Genre': genre,
-            'Release Date': release_date,
-            'Topic_1': topics_features['topics'][0] if topics_features else None,
-            'Topic_2': topics_features['topics'][1] if topics_features else None,
-            'Topic_3': topics_features['topics'][2] if topics_features else None,
-            'Feature_1': topics_features['features'][0] if topics_features else None,
-            'Feature_2': topics_features['features'][1] if topics_features else None,
-            'Feature_3': topics_features['features'][2] if topics_features else None,
+            'Artist': track_details.artist_name,
+            'Song': track_details.track_name,
+            'Genre': track_details.genre,
+            'Release Date': track_details.release_date,
+            'Topic_1': track_details.topic_1,
+            'Topic_2': track_details.topic_2,
+            'Topic_3': track_details.topic_3,
+            'Feature_1': track_details.feature_1,
+            'Feature_2': track_details.feature_2,
+            'Feature_3': track_details.feature_3,
         }
         final_playlist.append(playlist_line)
 
     # Create dynamic file name
-    safe_artist_name = "".join(c if c.isalnum() or c in (" ", "-", "_")
-                              else "" for c in initial_artist).replace(" ", "_")
-    safe_track_name = "".join(c if c.isalnum() or c in (" ", "-", "_")
-                              else "" for c in initial_song).replace(" ", "_")
+    safe_artist_name = UNSAFE_FILE_NAME_PATTERN.sub('', initial_artist).replace(" ", "_")
+    safe_track_name = UNSAFE_FILE_NAME_PATTERN.sub('', initial_song).replace(" ", "_")
     output_file = f'data/generated_playlist_from_{safe_artist_name}_{safe_track_name}.csv'
 
     # Save the playlist to a CSV file
@@ -214,6 +235,43 @@ def recommendation_system(initial_query_id, tracks_data, weights, max_playlist_s
     return final_playlist
 
 
+@lru_cache(maxsize=1)
+def load_tracks(file_path='data/final_processed_music_data.parquet', ids_file='data/topic_feature_ids.npy'):
+    """
+    Load the track data and build its arrays, once per set of files.
+
+    Parameters:
+    - file_path: Path to the processed track data Parquet file.
+    - ids_file: Path to the top topic and feature indices saved by preperation.py.
+
+    Returns:
+    - The DataFrame of track data and the dictionary of track arrays built from it.
+      They are cached and shared by every call, so they must not be modified.
+    """
+    # Read only the relevant columns
+    columns_to_use = [
+        'artist_id', 'track_id', 'genre', 'release_date', 'track_name', 'artist_name',
+        'topic_1', 'topic_2', 'topic_3',
+        'feature_1', 'feature_2', 'feature_3'
+    ]
+    tracks_data = pd.read_parquet(file_path, columns=columns_to_use)
+
+    # Artist names repeat across tracks, so store each one once
+    tracks_data = tracks_data.astype({'artist_name': 'category'})
+
+    # Load the top topic and feature indices saved alongside the track data
+    topic_feature_ids = np.load(ids_file, mmap_mode='r')
+
+    # Parse the track features into arrays once for every recommendation
+    track_arrays = vectorize_tracks(tracks_data, topic_feature_ids)
+
+    # The arrays are shared by every caller, so make them read-only
+    for array in track_arrays.values():
+        if isinstance(array, np.ndarray):
+            array.setflags(write=False)
+    return tracks_data, track_arrays
+
+
 # Define weights for each criterion
 weights = {
     'artist': 3,
@@ -223,30 +281,28 @@ weights = {
     'feature': 5
 }
 
-# Load vectorized track data
-file_path = 'data/final_processed_music_data.csv'
-tracks_data = pd.read_csv(file_path)
-
-# Retain only the relevant columns
-columns_to_use = [
-    'artist_id', 'track_id', 'genre', 'release_date', 'track_name', 'artist_name',
-    'topic_1', 'topic_2', 'topic_3',
-    'feature_1', 'feature_2', 'feature_3'
-]
-tracks_data = tracks_data[columns_to_use]
-
-# Demander à l'utilisateur de saisir un track_id valide entre 1 et 28372
-try:
-    initial_track_id = int(input("Entrez l'ID du morceau de départ (entre 1 et 28372) : "))
-    if initial_track_id < 1 or initial_track_id > 28372:
-        raise ValueError("L'ID doit être compris entre 1 et 28372.")
-except ValueError as e:
-    raise ValueError("Entrée invalide : {}".format(e))
-
-# Appel du système de recommandation
-recommended_playlist = recommendation_system(
-    initial_query_id=initial_track_id,
-    tracks_data=tracks_data,
-    weights=weights,
-    max_playlist_size=100
-)
+
+def main():
+    """Ask for a starting track and generate its playlist."""
+    tracks_data, track_arrays = load_tracks()
+
+    # Demander à l'utilisateur de saisir un track_id valide entre 1 et 28372
+    try:
+        initial_track_id = int(input("Entrez l'ID du morceau de départ (entre 1 et 28372) : "))
+        if initial_track_id < 1 or initial_track_id > 28372:
+            raise ValueError("L'ID doit être compris entre 1 et 28372.")
+    except ValueError as e:
+        raise ValueError("Entrée invalide : {}".format(e))
+
+    # Appel du système de recommandation
+    recommendation_system(
+        initial_query_id=initial_track_id,
+        tracks_data=tracks_data,
+        track_arrays=track_arrays,
+        weights=weights,
+        max_playlist_size=100
+    )
+
+
+if __name__ == '__main__':
+    main()